@@ -0,0 +1,72 @@
+import asyncio
+
+
+class MicroBatcher:
+    """Coalesce concurrent submit() calls into one flush call per batch.
+
+    Items queued within max_wait seconds of the first one (up to max_batch)
+    are passed together to flush_fn, an async function mapping a list of
+    items to a same-length sequence of results. If a batched call raises,
+    its items are retried one at a time so a single bad item can't fail
+    the others.
+    """
+
+    def __init__(self, flush_fn, max_batch: int = 16, max_wait: float = 0.02):
+        self.flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._flushes = set()  # strong refs so in-flight flush tasks aren't collected
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        # The queue and worker are bound to the loop that first uses them
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next batch can start filling
+            task = loop.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await self.flush_fn([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # One bad item fails the whole call, so retry each on its own
+                # and let only the items that still fail see an exception
+                await asyncio.gather(*(self._flush([entry]) for entry in batch))
+                return
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,11 +1,14 @@
+from typing import NotRequired, TypedDict
 import pydantic
 
 class RAGChunkAndSrc(pydantic.BaseModel):
     chunks: list[str]
     source_id: str = None
+    content_sha: str = None
 
-class RAGUpsertResult(pydantic.BaseModel):
+class RAGUpsertResult(TypedDict):  # plain dict: nothing to validate in a single count
     ingested: int
+    skipped: NotRequired[bool]
 
 class RAGSearchResult(pydantic.BaseModel):
     contexts: list[str]
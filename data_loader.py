@@ -1,26 +1,137 @@
-from openai import OpenAI
-from llama_index.readers.file import PDFReader
+import base64
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from openai import AsyncOpenAI
+from pypdf import PdfReader
+import tiktoken
 from llama_index.core.node_parser import SentenceSplitter
 from dotenv import load_dotenv
+from batching import MicroBatcher
 
 load_dotenv()
 
-client = OpenAI()
+aclient = AsyncOpenAI()
 EMBED_MODEL = "text-embedding-3-large"
 EMBED_DIM = 3072
+# Longest input the embedding model accepts, in cl100k_base tokens
+EMBED_MAX_TOKENS = 8191
+# Inputs sent per embeddings request, and how many requests may be in flight at once
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = 4
+# Pages parsed per worker task when a PDF is split across processes
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+
+# Query embeddings: in-process LRU backed by Redis, shared across workers
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 24 * 60 * 60  # seconds
+query_cache = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
 
 splitter = SentenceSplitter(chunk_size=1000, chunk_overlap=200)
 
 
-def load_and_chunk_pdf(path: str):
-    docs = PDFReader().load_data(file=path)
-    texts = [d.text for d in docs if getattr(d, "text", None)]
+def pdf_page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def load_and_chunk_pdf(path: str, start: int = 0, stop: int | None = None, num_pages: int | None = None):
+    """Extract and chunk pages [start, stop) of a PDF, one page at a time.
+
+    Pass num_pages when the caller already counted them, so the page tree isn't walked again.
+    """
+    reader = PdfReader(path)
+    if num_pages is None:
+        num_pages = len(reader.pages)
+    stop = num_pages if stop is None else min(stop, num_pages)
     chunk = []
-    for t in texts:
-        chunk.extend(splitter.split_text(t))
+    for i in range(start, stop):
+        text = reader.pages[i].extract_text()
+        if text:
+            chunk.extend(splitter.split_text(text))
     return chunk
 
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
-    response = client.embeddings.create(model=EMBED_MODEL, input=texts)
-    return [item.embedding for item in response.data]
+def _decode_embeddings(response, out: np.ndarray, rows) -> None:
+    # Requested as base64 so each vector decodes straight from its raw float32
+    # bytes, instead of the SDK parsing a list of Python floats. The Qdrant
+    # upsert still converts rows to lists, one slice at a time.
+    for item in response.data:
+        out[rows[item.index]] = np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32)
+
+
+def length_sorted_batches(texts: list[str], batch_size: int = EMBED_BATCH_SIZE) -> list[list[int]]:
+    """Split text indices into batches of similar-length texts."""
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+async def embed_texts_async(texts: list[str]) -> np.ndarray:
+    """Embed one batch of texts in a single request, returning a float32 (N, EMBED_DIM) array."""
+    response = await aclient.embeddings.create(
+        model=EMBED_MODEL,
+        input=texts,
+        encoding_format="base64",
+    )
+    out = np.empty((len(texts), EMBED_DIM), dtype=np.float32)
+    _decode_embeddings(response, out, range(len(texts)))
+    return out
+
+
+@functools.lru_cache(maxsize=1)
+def embed_encoding() -> tiktoken.Encoding:
+    # The first call may download the BPE file, so keep it off the event loop
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def exceeds_embed_limit(text: str) -> bool:
+    # A token covers at least one byte, so short texts never need encoding
+    if len(text.encode()) <= EMBED_MAX_TOKENS:
+        return False
+    return len(embed_encoding().encode(text)) > EMBED_MAX_TOKENS
+
+
+def normalize_query(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+# Concurrent query embeddings arriving within 20ms share one embeddings request
+embed_queue = MicroBatcher(embed_texts_async, max_batch=16, max_wait=0.02)
+_query_lru: OrderedDict[str, np.ndarray] = OrderedDict()
+
+
+async def embed_query(question: str) -> np.ndarray:
+    """Embed a search query, reusing cached vectors for repeated questions."""
+    q_norm = normalize_query(question)
+    vec = _query_lru.get(q_norm)
+    if vec is not None:
+        _query_lru.move_to_end(q_norm)
+        return vec
+
+    key = "qemb:" + hashlib.sha256(q_norm.encode()).hexdigest()
+    try:
+        cached = await query_cache.getex(key, ex=QUERY_CACHE_TTL)
+    except RedisError:
+        cached = None
+
+    if cached is not None:
+        vec = np.frombuffer(cached, dtype=np.float16).astype(np.float32)
+    else:
+        # The batcher returns a row view of the whole batch's array; copy it so
+        # the cached entry doesn't keep the other rows alive
+        vec = (await embed_queue.submit(q_norm)).copy()
+        try:
+            # Stored as float16 to halve cache size; cosine ranking is unaffected in practice
+            await query_cache.setex(key, QUERY_CACHE_TTL, vec.astype(np.float16).tobytes())
+        except RedisError:
+            pass
+
+    # Shared between callers through the LRU, so keep it immutable
+    vec.setflags(write=False)
+    _query_lru[q_norm] = vec
+    if len(_query_lru) > QUERY_CACHE_SIZE:
+        _query_lru.popitem(last=False)
+    return vec
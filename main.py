@@ -1,18 +1,66 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import functools
+import multiprocessing
+import numpy as np
+import json
 import logging
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 import inngest
 import inngest.fast_api
-from inngest.experimental import ai
+from openai import AsyncOpenAI
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+import string
+import tiktoken
 from dotenv import load_dotenv
 import uuid
 import os
 import datetime
-from data_loader import load_and_chunk_pdf, embed_texts
+import hashlib
+from data_loader import (
+    load_and_chunk_pdf,
+    pdf_page_count,
+    embed_encoding,
+    embed_query,
+    embed_texts_async,
+    exceeds_embed_limit,
+    normalize_query,
+    length_sorted_batches,
+    EMBED_BATCH_SIZE,
+    EMBED_CONCURRENCY,
+    EMBED_MAX_TOKENS,
+    PDF_PAGES_PER_TASK,
+)
 from vector_db import QdrantStorage
 from custom_types import RAGQueryResult, RAGSearchResult, RAGUpsertResult, RAGChunkAndSrc
 
 load_dotenv()
 
+# Answer tokens are relayed to the UI through a Redis stream per event
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+ANSWER_KEY = "answer:{event_id}"
+ANSWER_TTL = 600  # seconds
+STREAM_END = "\x00[DONE]"
+STREAM_ERROR = "\x00[ERROR]"  # answer incomplete; the UI should use the run output
+STREAM_TIMEOUT = 120  # seconds
+STREAM_BLOCK_MS = 5000  # longest single XREAD wait in /stream
+
+# Token budget for all retrieved contexts, split evenly across top_k
+MAX_CONTEXT_TOKENS = 8000
+MAX_TOP_K = 50
+
+SYSTEM_MSG = {"role": "system", "content": "You answer questions using only the provided context."}
+USER_PROMPT = string.Template(
+    "Use the following context to answer the question.\n\n"
+    "Context:\n$context\n\n"
+    "Question: $question\n"
+    "Answer concisely using the context above."
+)
+
 # Set up logging
 logging.basicConfig(
     level=logging.DEBUG,
@@ -27,6 +75,70 @@ inngest_client = inngest.Inngest(
     serializer=inngest.PydanticSerializer()
 )
 
+# PDF parsing is CPU-bound, so it runs in worker processes off the event loop.
+# Workers are spawned rather than forked so they never inherit the parent's
+# open gRPC channel to Qdrant.
+def _new_pdf_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+PDF_POOL = _new_pdf_pool()
+
+# Shared by every step; connects to Qdrant lazily on first use
+STORE = QdrantStorage()
+
+llm_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+
+
+def _file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _points_for_chunks(source_id: str, chunks: list[str]) -> tuple[list[str], list[dict]]:
+    # Same ids as uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}"), but the
+    # shared namespace + source prefix is hashed once and copied per chunk, and
+    # the version/variant bits are set on the digest directly rather than
+    # building a uuid.UUID object for every id.
+    prefix = hashlib.sha1(uuid.NAMESPACE_URL.bytes + f"{source_id}:".encode())
+    ids = [None] * len(chunks)
+    payloads = [None] * len(chunks)
+    for i, text in enumerate(chunks):
+        h = prefix.copy()
+        h.update(b"%d" % i)
+        d = bytearray(h.digest()[:16])
+        d[6] = (d[6] & 0x0F) | 0x50  # version 5
+        d[8] = (d[8] & 0x3F) | 0x80  # RFC 4122 variant
+        x = d.hex()
+        ids[i] = f"{x[:8]}-{x[8:12]}-{x[12:16]}-{x[16:20]}-{x[20:]}"
+        payloads[i] = {"source": source_id, "text": text}
+    return ids, payloads
+
+
+@functools.lru_cache(maxsize=1)
+def _prompt_encoding() -> tiktoken.Encoding:
+    # gpt-4o-mini's tokenizer. The first call may download and parse its BPE
+    # file, so it is warmed at startup (see lifespan) and never called on the loop.
+    return tiktoken.get_encoding("o200k_base")
+
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    # A token covers at least one byte, so short texts never need encoding
+    if len(text.encode()) <= max_tokens:
+        return text
+    tokens = _prompt_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _prompt_encoding().decode(tokens[:max_tokens])
+
+
+def _context_block(contexts: list[str], per_context: int) -> str:
+    return "\n\n".join(["- " + _truncate_tokens(c, per_context) for c in contexts])
+
 
 @inngest_client.create_function(
     fn_id="RAG: Ingest PDF",
@@ -43,36 +155,133 @@ inngest_client = inngest.Inngest(
     ),
 )
 async def rag_ingest_pdf(ctx: inngest.Context):
-    def _load(ctx: inngest.Context) -> RAGChunkAndSrc:
-        pdf_path = ctx.event.data["pdf_path"]
-        source_id = ctx.event.data.get("source_id", pdf_path)
-        chunks = load_and_chunk_pdf(pdf_path)
+    async def _check_duplicate(pdf_path: str, content_sha: str | None) -> dict:
+        # content_sha is only stamped once a file's points are all written (see
+        # _upsert), so a match means an earlier ingest of this content completed
+        if not content_sha:
+            content_sha = await asyncio.to_thread(_file_sha256, pdf_path)
+        return {"content_sha": content_sha, "duplicate": await STORE.ahas_content(content_sha)}
+    
+    async def _load(pdf_path: str, source_id: str, content_sha: str) -> RAGChunkAndSrc:
+        global PDF_POOL
+        loop = asyncio.get_running_loop()
+        pool = PDF_POOL
+        try:
+            num_pages = await loop.run_in_executor(pool, pdf_page_count, pdf_path)
+            # Fan page ranges out across the pool; gather keeps them in page order
+            parts = await asyncio.gather(*(
+                loop.run_in_executor(pool, load_and_chunk_pdf, pdf_path, start, start + PDF_PAGES_PER_TASK, num_pages)
+                for start in range(0, num_pages, PDF_PAGES_PER_TASK)
+            ))
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed on a huge PDF), which breaks the pool
+            # for good. Replace it once, even if several loads hit this together,
+            # and let Inngest retry the step on the new pool.
+            if PDF_POOL is pool:
+                logger.warning("PDF worker pool broke; starting a new one")
+                PDF_POOL = _new_pdf_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        chunks = [c for part in parts for c in part]
         logger.info(f"Loaded {len(chunks)} chunks from {pdf_path}")
-        return RAGChunkAndSrc(chunks=chunks, source_id=source_id)
+        return RAGChunkAndSrc(chunks=chunks, source_id=source_id, content_sha=content_sha)
     
-    def _upsert(chunks_and_src: RAGChunkAndSrc) -> RAGUpsertResult:
+    async def _upsert(chunks_and_src: RAGChunkAndSrc) -> RAGUpsertResult:
         chunks = chunks_and_src.chunks
         source_id = chunks_and_src.source_id
-        logger.info(f"Embedding {len(chunks)} chunks...")
-        vecs = embed_texts(chunks)
-        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(len(chunks))]
-        payloads = [{"source": source_id, "text": chunks[i]} for i in range(len(chunks))]
-        logger.info("Upserting to Qdrant...")
-        QdrantStorage().upsert(ids, vecs, payloads)
+        ids, payloads = _points_for_chunks(source_id, chunks)
+
+        # Identical chunks (repeated headers, footers, boilerplate) are embedded
+        # once; the vector is then written to every position that chunk occurs at.
+        groups: dict[bytes, list[int]] = {}
+        for i, text in enumerate(chunks):
+            groups.setdefault(hashlib.blake2b(text.encode(), digest_size=16).digest(), []).append(i)
+        positions = list(groups.values())
+        unique_texts = [chunks[p[0]] for p in positions]
+
+        # Each batch is upserted as soon as its embeddings arrive, so Qdrant
+        # writes overlap with the remaining embedding requests. The task groups
+        # cancel and await everything still running if any batch fails, so
+        # nothing keeps writing while Inngest retries the step.
+        sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        logger.info(f"Embedding {len(unique_texts)} unique of {len(chunks)} chunks and upserting...")
+        async with asyncio.TaskGroup() as upserts:
+            async def _embed_and_upsert(batch: list[int]):
+                async with sem:
+                    vecs = await embed_texts_async([unique_texts[u] for u in batch])
+                rows = [i for u in batch for i in positions[u]]
+                vecs = np.repeat(vecs, [len(positions[u]) for u in batch], axis=0)
+                upserts.create_task(
+                    STORE.aupsert([ids[i] for i in rows], vecs, [payloads[i] for i in rows])
+                )
+
+            async with asyncio.TaskGroup() as embeds:
+                for batch in length_sorted_batches(unique_texts, EMBED_BATCH_SIZE):
+                    embeds.create_task(_embed_and_upsert(batch))
+        # Ids are positional (source_id:i), so re-ingesting a source with fewer
+        # chunks leaves the old version's tail behind, still searchable and still
+        # carrying the old hash. Drop it before the new content is marked.
+        await STORE.aprune_source(source_id, ids)
+        # Written last: if any batch failed above, no point carries the hash and
+        # the retried or re-uploaded file is not mistaken for a duplicate
+        if ids and chunks_and_src.content_sha:
+            await STORE.amark_content(ids, chunks_and_src.content_sha)
         logger.info(f"Successfully upserted {len(chunks)} chunks")
         return RAGUpsertResult(ingested=len(chunks))
     
+    pdf_path = ctx.event.data["pdf_path"]
+    source_id = ctx.event.data.get("source_id", pdf_path)
+    
+    dup = await ctx.step.run(
+        "check-duplicate",
+        _check_duplicate,
+        pdf_path,
+        ctx.event.data.get("content_sha")
+    )
+    if dup["duplicate"]:
+        logger.info(f"Skipping {pdf_path}: content {dup['content_sha']} already ingested")
+        return RAGUpsertResult(ingested=0, skipped=True)
+    
     chunks_and_src = await ctx.step.run(
         "load-and-chunk", 
-        lambda: _load(ctx), 
+        _load,
+        pdf_path,
+        source_id,
+        dup["content_sha"],
         output_type=RAGChunkAndSrc
     )
     ingested = await ctx.step.run(
         "embed-and-upsert", 
-        lambda: _upsert(chunks_and_src), 
-        output_type=RAGUpsertResult
+        _upsert,
+        chunks_and_src
     )
-    return ingested.model_dump()
+    return ingested
+
+
+async def _relay_token(key: str, token: str) -> bool:
+    # Redis only carries the live stream, so a failure here costs streaming, not the answer
+    try:
+        # The TTL is refreshed with every token, so a stream abandoned by a dead
+        # worker still expires; one pipeline keeps it a single round trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"t": token})
+            pipe.expire(key, ANSWER_TTL)
+            await pipe.execute()
+        return True
+    except RedisError as e:
+        logger.warning(f"Answer streaming to {key} disabled: {e}")
+        return False
+
+
+async def _close_stream(key: str, marker: str):
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"t": marker})
+            pipe.expire(key, ANSWER_TTL)
+            await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not close answer stream {key}: {e}")
 
 
 @inngest_client.create_function(
@@ -80,13 +289,33 @@ async def rag_ingest_pdf(ctx: inngest.Context):
     trigger=inngest.TriggerEvent(event="rag/query_pdf_ai")
 )
 async def rag_query_pdf_ai(ctx: inngest.Context):
-    def _search(question: str, top_k: int = 5) -> RAGSearchResult:
+    key = ANSWER_KEY.format(event_id=ctx.event.id)
+    try:
+        return await _query_pdf_ai(ctx, key)
+    except Exception:
+        # Step errors only surface here once their retries are exhausted, so the
+        # run is failing for good; tell /stream/{event_id} to stop waiting.
+        await _close_stream(key, STREAM_ERROR)
+        raise
+
+
+async def _query_pdf_ai(ctx: inngest.Context, key: str):
+    async def _search(question: str, top_k: int = 5) -> RAGSearchResult:
+        # Bad queries are rejected before they can join (and fail) a micro-batch;
+        # retrying them can't help, so they fail the run right away
+        if not normalize_query(question):
+            raise inngest.NonRetriableError("Question is empty")
+        if len(question.encode()) > EMBED_MAX_TOKENS and await asyncio.to_thread(exceeds_embed_limit, question):
+            raise inngest.NonRetriableError(f"Question is longer than {EMBED_MAX_TOKENS} tokens")
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise inngest.NonRetriableError(f"top_k must be between 1 and {MAX_TOP_K}, got {top_k}")
         logger.info(f"Searching for: '{question}' with top_k={top_k}")
-        query_vec = embed_texts([question])[0]
-        store = QdrantStorage()
-        found = store.search(query_vec, top_k)
+        # Both calls are micro-batched with other queries arriving at the same time
+        query_vec = await embed_query(question)
+        found = await STORE.asearch(query_vec, top_k)
         logger.info(f"Found {len(found['contexts'])} contexts from {len(found['sources'])} sources")
-        return RAGSearchResult(contexts=found["contexts"], sources=found["sources"])
+        # Fields come straight from our own Qdrant payloads, so skip validation
+        return RAGSearchResult.model_construct(contexts=found["contexts"], sources=found["sources"])
     
     question = ctx.event.data["question"]
     top_k = int(ctx.event.data.get("top_k", 5))
@@ -95,41 +324,59 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
     
     found = await ctx.step.run(
         "embed-and-search", 
-        lambda: _search(question, top_k), 
+        _search,
+        question,
+        top_k,
         output_type=RAGSearchResult
     )
     
     logger.info(f"Search completed. Contexts: {len(found.contexts)}, Sources: {found.sources}")
     
-    context_block = "\n\n".join(f"- {c}" for c in found.contexts)
-    user_content = (
-        "Use the following context to answer the question.\n\n"
-        f"Context:\n{context_block}\n\n"
-        f"Question: {question}\n"
-        "Answer concisely using the context above."
-    )
+    # Cap each context so the prompt (and time-to-first-token) stays bounded.
+    # Tokenizing is CPU work (and may load the encoding), so it runs off the loop.
+    per_context = MAX_CONTEXT_TOKENS // max(top_k, 1)
+    context_block = await asyncio.to_thread(_context_block, found.contexts, per_context)
+    user_content = USER_PROMPT.substitute(context=context_block, question=question)
     
-    adapter = ai.openai.Adapter(
-        auth_key=os.getenv("OPENAI_API_KEY"),
-        model="gpt-4o-mini"
-    )
+    async def _answer() -> str:
+        # Tokens are pushed as they arrive so /stream/{event_id} can relay them
+        try:
+            await redis_client.delete(key)
+            relay = True
+        except RedisError as e:
+            logger.warning(f"Answer streaming to {key} disabled: {e}")
+            relay = False
+        parts = []
+        try:
+            stream = await llm_client.chat.completions.create(
+                model="gpt-4o-mini",
+                max_tokens=1024,
+                temperature=0.2,
+                messages=[
+                    SYSTEM_MSG,
+                    {"role": "user", "content": user_content}
+                ],
+                stream=True,
+            )
+            async for chunk in stream:
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    parts.append(token)
+                    if relay:
+                        relay = await _relay_token(key, token)
+        except Exception:
+            # A partial answer must not look finished; the retried step produces the full one
+            await _close_stream(key, STREAM_ERROR)
+            raise
+        # If relaying broke partway the stream is missing tokens, so flag it too
+        await _close_stream(key, STREAM_END if relay else STREAM_ERROR)
+        return "".join(parts)
     
     logger.info("Calling LLM for answer generation...")
-    res = await ctx.step.ai.infer(
-        "llm-answer",
-        adapter=adapter,
-        body={
-            "max_tokens": 1024,
-            "temperature": 0.2,
-            "messages": [
-                {"role": "system", "content": "You answer questions using only the provided context."},
-                {"role": "user", "content": user_content}
-            ]
-        }
-    )
+    answer = await ctx.step.run("llm-answer", _answer)
     
     logger.info("LLM response received")
-    answer = res["choices"][0]["message"]["content"].strip()
+    answer = answer.strip()
     logger.info(f"Answer generated: {answer[:100]}...")
     
     return {
@@ -139,10 +386,58 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
     }
 
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the tokenizers before serving so no query pays for their download on the loop
+    for encoding in (_prompt_encoding, embed_encoding):
+        try:
+            await asyncio.to_thread(encoding)
+        except Exception as e:
+            logger.warning(f"Could not preload tokenizer {encoding.__name__}: {e}")
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 def health():
     return {"status": "ok", "service": "production-ai-support-agent"}
 
+
+@app.get("/stream/{event_id}")
+async def stream_answer(event_id: str):
+    """Server-sent events relaying answer tokens for a rag/query_pdf_ai event."""
+    key = ANSWER_KEY.format(event_id=event_id)
+
+    async def _events():
+        last_id = "0-0"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STREAM_TIMEOUT
+        while (remaining := deadline - loop.time()) > 0:
+            # Blocks server-side until new tokens arrive, instead of polling
+            try:
+                response = await redis_client.xread(
+                    {key: last_id},
+                    block=max(min(int(remaining * 1000), STREAM_BLOCK_MS), 1),
+                )
+            except RedisError:
+                yield "event: error\ndata: {}\n\n"
+                return
+            if not response:
+                continue
+            _, entries = response[0]
+            last_id = entries[-1][0]
+            for _, fields in entries:
+                token = fields["t"]
+                if token == STREAM_END:
+                    yield "event: done\ndata: {}\n\n"
+                    return
+                if token == STREAM_ERROR:
+                    yield "event: error\ndata: {}\n\n"
+                    return
+                yield f"data: {json.dumps(token)}\n\n"
+        yield "event: timeout\ndata: {}\n\n"
+
+    return StreamingResponse(_events(), media_type="text/event-stream")
+
 inngest.fast_api.serve(app, inngest_client, [rag_ingest_pdf, rag_query_pdf_ai])
\ No newline at end of file
@@ -1,10 +1,17 @@
 from pathlib import Path
+import asyncio
+import hashlib
+import json
+import random
 import time
 import tempfile
 import streamlit as st
 import inngest
 from dotenv import load_dotenv
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
 load_dotenv()
@@ -40,16 +47,76 @@ def get_inngest_client() -> inngest.Inngest:
         )
 
 
-def save_uploaded_pdf_temp(file) -> Path:
-    """Save uploaded file to temp directory"""
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared session so polling reuses pooled connections"""
+    session = requests.Session()
+    # Retry dropped connections and rate-limit/gateway errors with a short backoff.
+    # Once retries run out the last response is returned rather than raised, so
+    # get_run_output keeps polling through a longer outage.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Shared HTTP/2 client for status probes"""
+    return httpx.Client(http2=True, timeout=3.0)
+
+
+def probe(url: str) -> dict:
+    """GET a status endpoint, returning its status code (None if unreachable) and JSON body"""
+    try:
+        r = get_http_client().get(url)
+    except httpx.HTTPError:
+        return {"status_code": None, "data": {}}
+    
+    try:
+        data = r.json()
+    except ValueError:
+        data = {}
+    return {"status_code": r.status_code, "data": data}
+
+
+@st.cache_data(ttl=5)
+def check_services() -> tuple[dict, dict]:
+    """Probe backend and Inngest concurrently; cached so quick reruns skip the network"""
+    urls = [f"{BACKEND_URL}/", f"{BACKEND_URL}/api/inngest"]
+    
+    async def _gather():
+        return await asyncio.gather(*(asyncio.to_thread(probe, url) for url in urls))
+    
+    backend, inngest_status = asyncio.run(_gather())
+    return backend, inngest_status
+
+
+def save_uploaded_pdf_temp(file, content_sha: str) -> Path:
+    """Save uploaded file to temp directory, keyed by content hash"""
     temp_dir = Path(tempfile.gettempdir()) / "rag_uploads"
     temp_dir.mkdir(parents=True, exist_ok=True)
     
-    file_path = temp_dir / file.name
+    file_path = temp_dir / f"{content_sha}.pdf"
     
-    # Write file bytes
-    with open(file_path, "wb") as f:
-        f.write(file.getbuffer())
+    # Identical uploads map to the same file, so only write it once. It is
+    # written under a unique name and renamed into place, so the final name
+    # never points at a partial file from an interrupted or concurrent write.
+    if not file_path.exists():
+        fd, tmp_name = tempfile.mkstemp(dir=temp_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(file.getbuffer())
+            os.replace(tmp_name, file_path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
     
     return file_path
 
@@ -62,13 +129,16 @@ def get_run_output(event_id: str, timeout: int = 120) -> dict:
             "error": "INNGEST_EVENT_KEY not set. Check Inngest Dashboard manually."
         }
     
+    session = get_http_session()
     start_time = time.time()
     progress_bar = st.progress(0)
     status_text = st.empty()
+    attempt = 0
+    last_status = None
     
     while time.time() - start_time < timeout:
         try:
-            response = requests.get(
+            response = session.get(
                 f"{INNGEST_API_BASE}/events/{event_id}/runs",
                 headers={"Authorization": f"Bearer {INNGEST_EVENT_KEY}"},
                 timeout=5
@@ -82,6 +152,11 @@ def get_run_output(event_id: str, timeout: int = 120) -> dict:
                     run = runs[0]
                     status = run.get("status", "Unknown")
                     
+                    # Poll tightly again once the run starts executing
+                    if status == "Running" and last_status != "Running":
+                        attempt = 0
+                    last_status = status
+                    
                     # Update progress
                     elapsed = time.time() - start_time
                     progress = min(elapsed / timeout, 1.0)
@@ -105,7 +180,11 @@ def get_run_output(event_id: str, timeout: int = 120) -> dict:
                             "error": f"Run {status.lower()}"
                         }
             
-            time.sleep(1)
+            # Exponential backoff with jitter: 0.25s growing to a 4s cap
+            delay = min(0.25 * (1.5 ** attempt) + random.uniform(0, 0.1), 4.0)
+            remaining = timeout - (time.time() - start_time)
+            time.sleep(max(min(delay, remaining), 0))
+            attempt += 1
         
         except requests.exceptions.RequestException as e:
             progress_bar.empty()
@@ -131,6 +210,30 @@ def get_run_output(event_id: str, timeout: int = 120) -> dict:
     }
 
 
+class AnswerStreamError(Exception):
+    """The streamed answer is incomplete; use the run output instead"""
+
+
+def stream_answer(event_id: str):
+    """Yield answer tokens from the backend's SSE stream as they are generated"""
+    session = get_http_session()
+    with session.get(
+        f"{BACKEND_URL}/stream/{event_id}",
+        stream=True,
+        timeout=(5, 120)
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+                if event == "done":
+                    return
+                # "error" or "timeout": whatever was streamed may be partial
+                raise AnswerStreamError(event)
+            if line.startswith("data:"):
+                yield json.loads(line[len("data:"):].strip())
+
+
 # ====== MAIN UI ======
 
 st.title("📄 RAG PDF System")
@@ -139,26 +242,23 @@ st.title("📄 RAG PDF System")
 with st.sidebar:
     st.header("🔧 System Status")
     
+    backend, inngest_status = check_services()
+    
     # Check Backend
-    try:
-        r = requests.get(f"{BACKEND_URL}/", timeout=3)
-        if r.status_code == 200:
-            st.success("✅ Backend API")
-        else:
-            st.error(f"❌ Backend ({r.status_code})")
-    except Exception as e:
+    if backend["status_code"] == 200:
+        st.success("✅ Backend API")
+    elif backend["status_code"] is None:
         st.error(f"❌ Backend (unreachable)")
+    else:
+        st.error(f"❌ Backend ({backend['status_code']})")
     
     # Check Inngest
-    try:
-        r = requests.get(f"{BACKEND_URL}/api/inngest", timeout=3)
-        if r.status_code == 200:
-            data = r.json()
-            st.success(f"✅ Inngest ({data.get('function_count', 0)} functions)")
-        else:
-            st.error(f"❌ Inngest ({r.status_code})")
-    except Exception as e:
+    if inngest_status["status_code"] == 200:
+        st.success(f"✅ Inngest ({inngest_status['data'].get('function_count', 0)} functions)")
+    elif inngest_status["status_code"] is None:
         st.error(f"❌ Inngest (unreachable)")
+    else:
+        st.error(f"❌ Inngest ({inngest_status['status_code']})")
     
     st.divider()
     
@@ -195,7 +295,8 @@ with col1:
             with st.spinner("Uploading and triggering ingestion..."):
                 try:
                     # Save file temporarily
-                    file_path = save_uploaded_pdf_temp(uploaded)
+                    content_sha = hashlib.sha256(uploaded.getbuffer()).hexdigest()
+                    file_path = save_uploaded_pdf_temp(uploaded, content_sha)
                     
                     # Get Inngest client
                     client = get_inngest_client()
@@ -206,7 +307,8 @@ with col1:
                             name="rag/ingest_pdf",
                             data={
                                 "pdf_path": str(file_path),
-                                "source_id": uploaded.name
+                                "source_id": uploaded.name,
+                                "content_sha": content_sha
                             }
                         )
                     )
@@ -222,7 +324,10 @@ with col1:
                         if result["success"]:
                             output = result["output"]
                             chunks = output.get("ingested", 0)
-                            st.success(f"🎉 Successfully ingested **{chunks} chunks**!")
+                            if output.get("skipped"):
+                                st.success("🎉 This PDF is already ingested - nothing to do!")
+                            else:
+                                st.success(f"🎉 Successfully ingested **{chunks} chunks**!")
                         elif "INNGEST_EVENT_KEY not set" in result.get("error", ""):
                             st.info("💡 Check [Inngest Dashboard](https://app.inngest.com) for progress")
                         else:
@@ -282,16 +387,26 @@ with col2:
                         st.success("✅ Query submitted!")
                         st.caption(f"Event ID: `{event_id}`")
                         
-                        # Get result
+                        # Stream the answer while the LLM step is still running
+                        st.subheader("💡 Answer")
+                        answer_box = st.empty()
+                        try:
+                            with answer_box.container():
+                                streamed = st.write_stream(stream_answer(event_id))
+                        except (requests.exceptions.RequestException, AnswerStreamError):
+                            streamed = None
+                        
+                        # Get result (sources arrive with the finished run)
                         result = get_run_output(event_id)
                         
                         if result["success"]:
                             output = result["output"]
                             
-                            # Display answer
-                            st.subheader("💡 Answer")
-                            answer = output.get("answer", "No answer generated")
-                            st.markdown(answer)
+                            # Fall back to the run output if streaming was unavailable,
+                            # replacing any partial text the stream left behind
+                            if not streamed:
+                                answer = output.get("answer", "No answer generated")
+                                answer_box.markdown(answer)
                             
                             # Display sources
                             sources = output.get("sources", [])
@@ -304,7 +419,8 @@ with col2:
                                     st.write(f"- {source}")
                         
                         elif "INNGEST_EVENT_KEY not set" in result.get("error", ""):
-                            st.info("💡 Check [Inngest Dashboard](https://app.inngest.com) for answer")
+                            if not streamed:
+                                st.info("💡 Check [Inngest Dashboard](https://app.inngest.com) for answer")
                         
                         else:
                             st.warning(f"⚠️ {result.get('error', 'Unknown error')}")
@@ -1,37 +1,186 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+import asyncio
+import os
+import threading
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Batch,
+    Datatype,
+    Distance,
+    FieldCondition,
+    Filter,
+    HasIdCondition,
+    HnswConfigDiff,
+    MatchValue,
+    OptimizersConfigDiff,
+    PayloadSchemaType,
+    QueryRequest,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
+from batching import MicroBatcher
+
+# Points sent per Qdrant upsert request
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "64"))
+
+# gRPC keeps one multiplexed HTTP/2 channel open and sends vectors as protobuf.
+# It listens on its own port (6334 by default), separate from the REST url.
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+GRPC_OPTIONS = {
+    "grpc.keepalive_time_ms": 30000,
+    "grpc.max_send_message_length": 256 << 20,
+}
+
+# Graph search breadth; small top_k needs fewer candidates (see _search_params)
+HNSW_EF = 64
+HNSW_EF_SMALL_K = 32
 
 class QdrantStorage:
-    def __init__(self, url="http://localhost:6333", collection="docs", dim=3072):
-        self.client = QdrantClient(url=url, timeout=30)
+    # Clients (and their channels) are shared by every instance for the same
+    # server; _lock guards the dict across FastAPI worker threads and is only
+    # ever held for the lookup, never across network I/O.
+    _clients: dict[tuple[str, int], AsyncQdrantClient] = {}
+    _lock = threading.Lock()
+    # Keyword indexes so filtering by source or file hash doesn't scan every payload
+    _KEYWORD_FIELDS = ("source", "content_sha")
+
+    def __init__(self, url="http://localhost:6333", collection="docs", dim=3072, grpc_port=QDRANT_GRPC_PORT):
+        # No network I/O here, so instances can be created at import time;
+        # the connection and collection check happen on first use.
+        self.url = url
+        self.grpc_port = grpc_port
         self.collection = collection
-        if not self.client.collection_exists(self.collection):
-            self.client.create_collection(
-                collection_name=self.collection,
-                vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
-            )
+        self.dim = dim
+        self._ready = False
+        # Collection setup runs once per instance through the async client, so
+        # the event loop never blocks on a thread lock or a sync gRPC call
+        self._alock = asyncio.Lock()
+        self._search_batcher = MicroBatcher(self._search_batch, max_batch=16, max_wait=0.02)
+
+    def _shared_client(self) -> AsyncQdrantClient:
+        # Constructing the client does no I/O; the channel opens on first request
+        key = (self.url, self.grpc_port)
+        with QdrantStorage._lock:
+            if key not in QdrantStorage._clients:
+                QdrantStorage._clients[key] = AsyncQdrantClient(
+                    url=self.url,
+                    grpc_port=self.grpc_port,
+                    timeout=30,
+                    prefer_grpc=True,
+                    grpc_options=GRPC_OPTIONS,
+                )
+            return QdrantStorage._clients[key]
+
+    def _collection_config(self) -> dict:
+        return dict(
+            collection_name=self.collection,
+            # Originals stored as float16: half the disk/RAM of float32 for rescoring
+            vectors_config=VectorParams(size=self.dim, distance=Distance.COSINE, datatype=Datatype.FLOAT16),
+            # int8 copies kept in RAM for graph traversal; originals used to rescore
+            quantization_config=ScalarQuantization(
+                scalar=ScalarQuantizationConfig(
+                    type=ScalarType.INT8,
+                    quantile=0.99,
+                    always_ram=True,
+                )
+            ),
+            hnsw_config=HnswConfigDiff(m=24, ef_construct=200, on_disk=False, payload_m=0),
+            # Segments under ~20 MB of vectors (threshold is in KB) are searched without a graph
+            optimizers_config=OptimizersConfigDiff(indexing_threshold=20000),
+        )
+
+    async def _aclient(self) -> AsyncQdrantClient:
+        aclient = self._shared_client()
+        if self._ready:
+            return aclient
+        async with self._alock:
+            if not self._ready:
+                if not await aclient.collection_exists(self.collection):
+                    await aclient.create_collection(**self._collection_config())
+                # Outside the existence check so collections created before an
+                # index was added get it too; re-creating an index is a no-op
+                for field in self._KEYWORD_FIELDS:
+                    await aclient.create_payload_index(
+                        collection_name=self.collection,
+                        field_name=field,
+                        field_schema=PayloadSchemaType.KEYWORD,
+                    )
+                self._ready = True
+        return aclient
+
+    async def aupsert(self, ids, vectors, payloads):
+        aclient = await self._aclient()
+        # vectors arrives as a float32 ndarray, but the client serializes points
+        # from Python lists (its upload_collection calls .tolist() on ndarrays
+        # too), so each slice is converted once here, right before it is sent.
+        # TaskGroup cancels the remaining requests if one fails
+        async with asyncio.TaskGroup() as tg:
+            for i in range(0, len(ids), UPSERT_BATCH_SIZE):
+                tg.create_task(aclient.upsert(
+                    collection_name=self.collection,
+                    points=Batch(
+                        ids=ids[i:i + UPSERT_BATCH_SIZE],
+                        vectors=vectors[i:i + UPSERT_BATCH_SIZE].tolist(),
+                        payloads=payloads[i:i + UPSERT_BATCH_SIZE],
+                    ),
+                    wait=True,
+                ))
+
+    async def aprune_source(self, source_id: str, keep_ids):
+        """Delete points of source_id other than keep_ids, e.g. the tail of a longer earlier version."""
+        aclient = await self._aclient()
+        await aclient.delete(
+            collection_name=self.collection,
+            points_selector=Filter(
+                must=[FieldCondition(key="source", match=MatchValue(value=source_id))],
+                must_not=[HasIdCondition(has_id=keep_ids)] if keep_ids else None,
+            ),
+            wait=True,
+        )
 
-    def upsert(self, ids, vectors, payloads):
-        points = [
-            PointStruct(id=ids[i], vector=vectors[i], payload=payloads[i])
-            for i in range(len(ids))
-        ]
-        self.client.upsert(collection_name=self.collection, points=points)
+    async def amark_content(self, ids, content_sha: str):
+        """Tag already-upserted points as coming from the file with this SHA-256."""
+        aclient = await self._aclient()
+        await aclient.set_payload(
+            collection_name=self.collection,
+            payload={"content_sha": content_sha},
+            points=ids,
+            wait=True,
+        )
 
-    def search(self, query_vector, top_k: int = 5):
-        # ✅ Fixed: Use query_points instead of search
-        results = self.client.query_points(
+    async def ahas_content(self, content_sha: str) -> bool:
+        """Whether a file with this SHA-256 was fully ingested (see amark_content)."""
+        aclient = await self._aclient()
+        points, _ = await aclient.scroll(
             collection_name=self.collection,
-            query=query_vector,
-            limit=top_k,
-            with_payload=True,
+            scroll_filter=Filter(must=[FieldCondition(key="content_sha", match=MatchValue(value=content_sha))]),
+            limit=1,
+            with_payload=False,
+            with_vectors=False,
+        )
+        return bool(points)
+
+    @staticmethod
+    def _search_params(top_k: int) -> SearchParams:
+        return SearchParams(
+            hnsw_ef=HNSW_EF_SMALL_K if top_k <= 5 else HNSW_EF,
+            quantization=QuantizationSearchParams(
+                ignore=False,
+                rescore=True,
+                oversampling=2.0,
+            )
         )
-        
+
+    @staticmethod
+    def _to_result(points) -> dict:
         contexts = []
         sources = set()
 
-        # ✅ Fixed: Access results.points
-        for point in results.points:
+        for point in points:
             payload = point.payload or {}
             text = payload.get("text", "")
             source = payload.get("source", "")
@@ -39,4 +188,24 @@ class QdrantStorage:
                 contexts.append(text)
                 sources.add(source)
 
-        return {"contexts": contexts, "sources": list(sources)}
\ No newline at end of file
+        return {"contexts": contexts, "sources": list(sources)}
+
+    async def asearch(self, query_vector, top_k: int = 5):
+        """Search the top_k nearest chunks; concurrent calls are fused into one batched Qdrant request."""
+        return await self._search_batcher.submit((query_vector, top_k))
+
+    async def _search_batch(self, queries):
+        aclient = await self._aclient()
+        responses = await aclient.query_batch_points(
+            collection_name=self.collection,
+            requests=[
+                QueryRequest(
+                    query=np.asarray(query_vector, dtype=np.float32).tolist(),
+                    limit=top_k,
+                    with_payload=True,
+                    params=self._search_params(top_k),
+                )
+                for query_vector, top_k in queries
+            ],
+        )
+        return [self._to_result(response.points) for response in responses]